@@ -1,10 +1,11 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from sqlmodel import select
 
 from browserstrategygame.database import (
     BuildingTemplate,
     DatabaseDep,
 )
+from browserstrategygame.throttle import coalesce, rate_limit
 
 router = APIRouter(
     prefix="/building-templates",
@@ -12,7 +13,7 @@ router = APIRouter(
 )
 
 
-@router.get("")
+@router.get("", dependencies=[Depends(rate_limit)])
 def search_building_templates(db: DatabaseDep):
     query = select(BuildingTemplate).where(BuildingTemplate.not_deleted)
-    return db.exec(query).all()
+    return coalesce("building-templates", lambda: db.exec(query).all())
@@ -1,16 +1,23 @@
+from datetime import datetime, UTC
 from http import HTTPStatus
+from typing import cast
 
-from fastapi import APIRouter, Response
+from fastapi import APIRouter, Depends, Response
 from pydantic import BaseModel
-from sqlmodel import select
+from sqlalchemy import CursorResult, update
+from sqlalchemy.orm.exc import NoResultFound
+from sqlmodel import col, select
 
+from browserstrategygame import snapshot, state
 from browserstrategygame.database import (
     Building,
     BuildingTemplate,
     DatabaseDep,
     Player,
-    Storage,
 )
+from browserstrategygame.leaderboards import leaderboards
+from browserstrategygame.ledger import Ledger, save_ledgers
+from browserstrategygame.throttle import coalesce, rate_limit
 
 router = APIRouter(
     prefix="/buildings",
@@ -18,10 +25,13 @@ router = APIRouter(
 )
 
 
-@router.get("")
+@router.get("", dependencies=[Depends(rate_limit)])
 def search_buildings(db: DatabaseDep):
+    if view := snapshot.current:
+        return view.respond(view.buildings)
+
     query = select(Building).where(Building.not_deleted)
-    return db.exec(query).all()
+    return coalesce("buildings", lambda: db.exec(query).all())
 
 
 class BlankBuilding(BaseModel):
@@ -38,20 +48,42 @@ def create_building(data: BlankBuilding, db: DatabaseDep):
             BuildingTemplate.id == data.building_template_id,
         )
     ).one()
-    player = db.exec(
-        select(Player).where(Player.not_deleted, Player.id == data.player_id)
+    db.exec(
+        select(Player.id).where(Player.not_deleted, Player.id == data.player_id)
     ).one()
-    db.exec(select(Storage).where(Storage.player_id == data.player_id)).all()
-    db.add(building)
-    for material_cost in building_template.material_costs:
-        if not player.pay_stored_material(
-            material_cost.material_id, material_cost.quantity
-        ):
-            db.rollback()
-            return Response(status_code=HTTPStatus.UNPROCESSABLE_ENTITY)
-
-    db.commit()
-    db.refresh(building)
+    costs = [
+        (material_cost.material_id, material_cost.quantity)
+        for material_cost in building_template.material_costs
+    ]
+
+    with leaderboards.lock:
+        if state.game:
+            # Save the building before paying, so the log never has a payment for
+            # a building that wasn't saved. Committing also ends the transaction,
+            # as the writer may need the database to checkpoint while we wait on it.
+            db.add(building)
+            db.commit()
+            if not state.game.build(data.player_id, data.building_template_id, costs):
+                db.delete(building)
+                db.commit()
+                return Response(status_code=HTTPStatus.UNPROCESSABLE_ENTITY)
+        else:
+            ledger = Ledger.load(db, data.player_id)
+            if not ledger.pay(costs):
+                db.rollback()
+                return Response(status_code=HTTPStatus.UNPROCESSABLE_ENTITY)
+
+            db.add(building)
+            save_ledgers(db, [ledger])
+            db.commit()
+
+        db.refresh(building)
+
+        leaderboards.credit(
+            (data.player_id, material_id, -quantity) for material_id, quantity in costs
+        )
+        leaderboards.build(data.player_id, data.building_template_id)
+
     return building
 
 
@@ -66,7 +98,25 @@ def get_building(id: int, db: DatabaseDep):
 def delete_building(id: int, db: DatabaseDep):
     query = select(Building).where(Building.not_deleted, Building.id == id)
     building = db.exec(query).one()
-    building.delete()
-    db.commit()
-    db.refresh(building)
+
+    with leaderboards.lock:
+        # Of concurrent deletes, only the one that soft-deletes the row uncounts it.
+        result = cast(
+            CursorResult,
+            db.execute(
+                update(Building)
+                .where(Building.not_deleted, col(Building.id) == id)
+                .values(deleted_at=datetime.now(UTC))
+            ),
+        )
+        db.commit()
+        if result.rowcount != 1:
+            raise NoResultFound()
+        db.refresh(building)
+
+        if state.game:
+            state.game.demolish(building.player_id, building.building_template_id)
+
+        leaderboards.build(building.player_id, building.building_template_id, -1)
+
     return building
@@ -1,7 +1,8 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from sqlmodel import select
 
 from browserstrategygame.database import DatabaseDep, MaterialCost
+from browserstrategygame.throttle import coalesce, rate_limit
 
 router = APIRouter(
     prefix="/material-costs",
@@ -9,7 +10,7 @@ router = APIRouter(
 )
 
 
-@router.get("")
+@router.get("", dependencies=[Depends(rate_limit)])
 def search_material_costs(db: DatabaseDep):
     query = select(MaterialCost).where(MaterialCost.not_deleted)
-    return db.exec(query).all()
+    return coalesce("material-costs", lambda: db.exec(query).all())
@@ -1,7 +1,8 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from sqlmodel import select
 
 from browserstrategygame.database import DatabaseDep, MaterialYield
+from browserstrategygame.throttle import coalesce, rate_limit
 
 router = APIRouter(
     prefix="/material-yields",
@@ -9,7 +10,7 @@ router = APIRouter(
 )
 
 
-@router.get("")
+@router.get("", dependencies=[Depends(rate_limit)])
 def search_material_yields(db: DatabaseDep):
     query = select(MaterialYield).where(MaterialYield.not_deleted)
-    return db.exec(query).all()
+    return coalesce("material-yields", lambda: db.exec(query).all())
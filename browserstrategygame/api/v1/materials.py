@@ -1,7 +1,8 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from sqlmodel import select
 
 from browserstrategygame.database import DatabaseDep, Material
+from browserstrategygame.throttle import coalesce, rate_limit
 
 router = APIRouter(
     prefix="/materials",
@@ -9,10 +10,10 @@ router = APIRouter(
 )
 
 
-@router.get("")
+@router.get("", dependencies=[Depends(rate_limit)])
 def search_materials(db: DatabaseDep):
     query = select(Material).where(Material.not_deleted)
-    return db.exec(query).all()
+    return coalesce("materials", lambda: db.exec(query).all())
 
 
 @router.get("/{id}")
@@ -1,10 +1,12 @@
 from http import HTTPStatus
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from pydantic import BaseModel
 from sqlmodel import select
 
 from browserstrategygame.database import DatabaseDep, Player
+from browserstrategygame.leaderboards import leaderboards
+from browserstrategygame.throttle import coalesce, rate_limit
 
 router = APIRouter(
     prefix="/players",
@@ -12,10 +14,10 @@ router = APIRouter(
 )
 
 
-@router.get("")
+@router.get("", dependencies=[Depends(rate_limit)])
 def search_players(db: DatabaseDep):
     query = select(Player).where(Player.not_deleted)
-    return db.exec(query).all()
+    return coalesce("players", lambda: db.exec(query).all())
 
 
 class BlankPlayer(BaseModel):
@@ -29,6 +31,7 @@ def create_player(data: BlankPlayer, db: DatabaseDep):
     db.add(player)
     db.commit()
     db.refresh(player)
+    leaderboards.forget(player.realm_id)
     return player
 
 
@@ -60,4 +63,5 @@ def delete_player(id: int, db: DatabaseDep):
     player.delete()
     db.commit()
     db.refresh(player)
+    leaderboards.forget(player.realm_id)
     return player
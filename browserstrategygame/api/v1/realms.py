@@ -1,8 +1,10 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from sqlmodel import select
 from pydantic import BaseModel
 
 from browserstrategygame.database import DatabaseDep, Realm
+from browserstrategygame.leaderboards import leaderboards
+from browserstrategygame.throttle import coalesce, rate_limit
 
 router = APIRouter(
     prefix="/realms",
@@ -23,11 +25,10 @@ def create_realm(data: BlankRealm, db: DatabaseDep):
     return realm
 
 
-@router.get("")
+@router.get("", dependencies=[Depends(rate_limit)])
 def search_realms(db: DatabaseDep):
     query = select(Realm).where(Realm.not_deleted)
-    realms = db.exec(query).all()
-    return realms
+    return coalesce("realms", lambda: db.exec(query).all())
 
 
 @router.get("/{id}")
@@ -35,3 +36,18 @@ def get_player(id: int, db: DatabaseDep):
     query = select(Realm).where(Realm.not_deleted, Realm.id == id)
     realm = db.exec(query).one()
     return realm
+
+
+@router.get("/{id}/leaderboard", dependencies=[Depends(rate_limit)])
+def get_leaderboard(id: int, db: DatabaseDep):
+    """
+    Realm totals and its top players by balance of each material and by buildings.
+
+    Every player's balances are kept in memory for realms that were read, and
+    rankings are updated as balances change. A top player spending can make the
+    next read rank the whole realm again for that material.
+    """
+
+    query = select(Realm.id).where(Realm.not_deleted, Realm.id == id)
+    db.exec(query).one()
+    return leaderboards.summary(db, id)
@@ -1,7 +1,9 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from sqlmodel import select
 
+from browserstrategygame import snapshot, state
 from browserstrategygame.database import DatabaseDep, Storage
+from browserstrategygame.throttle import coalesce, rate_limit
 
 router = APIRouter(
     prefix="/players/{player_id}/storage",
@@ -9,7 +11,16 @@ router = APIRouter(
 )
 
 
-@router.get("")
+@router.get("", dependencies=[Depends(rate_limit)])
 def search_storage(player_id: int, db: DatabaseDep):
+    if view := snapshot.current:
+        return view.respond(view.storage.get(player_id, b"[]"))
+
+    if state.game:
+        return [
+            Storage(player_id=player_id, material_id=material_id, balance=balance)
+            for material_id, balance in state.game.storage(player_id)
+        ]
+
     query = select(Storage).where(Storage.player_id == player_id)
-    return db.exec(query).all()
+    return coalesce(("storage", player_id), lambda: db.exec(query).all())
@@ -1,18 +1,28 @@
 from datetime import datetime, timedelta, UTC
 from http import HTTPStatus
+from threading import Lock
+from typing import Optional, cast
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import JSONResponse
 from sqlalchemy.orm.exc import NoResultFound
-from sqlmodel import col, select
+from sqlmodel import Session, col, select
 
+from browserstrategygame import snapshot, state
 from browserstrategygame.database import (
-    Building,
     DatabaseDep,
-    MaterialYield,
-    Storage,
     Tick,
+    TickHead,
+    TickSummary,
 )
+from browserstrategygame.leaderboards import leaderboards
+from browserstrategygame.pipeline import (
+    load_material_yields,
+    load_world,
+    pipeline,
+    save_world,
+)
+from browserstrategygame.throttle import coalesce, rate_limit
 
 router = APIRouter(
     prefix="/ticks",
@@ -20,10 +30,38 @@ router = APIRouter(
 )
 
 
-@router.get("")
+@router.get("", dependencies=[Depends(rate_limit)])
 def search_ticks(db: DatabaseDep):
+    if view := snapshot.current:
+        return view.respond(view.ticks)
+
     query = select(Tick).order_by(col(Tick.created_at).desc())
-    return db.exec(query).all()
+    return coalesce("ticks", lambda: db.exec(query).all())
+
+
+@router.get("/current")
+def get_current_tick(db: DatabaseDep):
+    query = select(Tick).join(TickHead, col(TickHead.tick_id) == Tick.id)
+    return db.exec(query).one()
+
+
+@router.get("/summaries", dependencies=[Depends(rate_limit)])
+def search_tick_summaries(db: DatabaseDep):
+    query = select(TickSummary).order_by(col(TickSummary.started_at).desc())
+    return coalesce("tick-summaries", lambda: db.exec(query).all())
+
+
+@router.get("/stages")
+def search_tick_stages():
+    timings = pipeline.timings
+    return [
+        {
+            "position": position,
+            "name": getattr(stage, "__name__", repr(stage)),
+            "seconds": timings[position] if position < len(timings) else None,
+        }
+        for position, stage in enumerate(pipeline.stages)
+    ]
 
 
 @router.get("/{tick_id}")
@@ -32,51 +70,155 @@ def get_tick(tick_id: int, db: DatabaseDep):
     return db.exec(query).one()
 
 
-@router.post("")
-def create_tick(db: DatabaseDep):
+# Held while a tick is being applied.
+ticking = Lock()
+
+# Earliest the next tick can be created, seeded from the tick head by the first
+# attempt and moved forward by every tick since.
+next_tick_at: Optional[datetime] = None
+
+
+def guard_tick():
+    """
+    Reject early and concurrent tick attempts before they open a database session.
+    """
+
+    if next_tick_at and next_tick_at > datetime.now(UTC):
+        raise HTTPException(
+            HTTPStatus.CONFLICT, f"Can only tick once every {Tick.LENGTH} seconds"
+        )
+
+    if not ticking.acquire(blocking=False):
+        raise HTTPException(HTTPStatus.CONFLICT, "Tick already in progress")
+
     try:
-        ticked_at = db.exec(
-            select(Tick.created_at).order_by(col(Tick.created_at).desc()).limit(1)
-        ).one()
-    except NoResultFound:
-        ticked_at = datetime.now(UTC) - timedelta(seconds=Tick.LENGTH)
+        yield
+    finally:
+        ticking.release()
 
-    tick = Tick(created_at=ticked_at + timedelta(seconds=Tick.LENGTH))
 
-    if tick.created_at > datetime.now(UTC):
+@router.post("", dependencies=[Depends(rate_limit), Depends(guard_tick)])
+def create_tick(db: DatabaseDep):
+    global next_tick_at
+
+    head = db.get(TickHead, 1)
+    if head:
+        ticked_at = head.ticked_at
+    else:
+        # The tick history predates the head, find the latest tick the slow way.
+        try:
+            ticked_at = db.exec(
+                select(Tick.created_at).order_by(col(Tick.created_at).desc()).limit(1)
+            ).one()
+        except NoResultFound:
+            ticked_at = datetime.now(UTC) - timedelta(seconds=Tick.LENGTH)
+
+    # SQLite doesn't keep the timezone.
+    ticked_at = ticked_at.replace(tzinfo=UTC)
+    created_at = ticked_at + timedelta(seconds=Tick.LENGTH)
+    tick = Tick(created_at=created_at)
+
+    if created_at > datetime.now(UTC):
+        next_tick_at = created_at
         return JSONResponse(
             {"detail": f"Can only tick once every {Tick.LENGTH} seconds"},
             HTTPStatus.CONFLICT,
         )
 
-    buildings = db.exec(select(Building).where(Building.not_deleted)).all()
-
-    for building in buildings:
-        material_yields = db.exec(
-            select(MaterialYield).where(
-                MaterialYield.building_template_id == building.building_template_id
-            )
-        ).all()
-
-        for material_yield in material_yields:
-            try:
-                storage = db.exec(
-                    select(Storage).where(
-                        Storage.player_id == building.player_id,
-                        Storage.material_id == material_yield.material_id,
-                    )
-                ).one()
-            except NoResultFound:
-                storage = Storage(
-                    player_id=building.player_id,
-                    material_id=material_yield.material_id,
-                    balance=0,
-                )
-                db.add(storage)
-
-            storage.balance += material_yield.quantity
+    with leaderboards.lock:
+        if state.game:
+            # Tick in memory before writing, as the writer may need the database
+            # to checkpoint while we wait on it.
+            deltas = state.game.tick(load_material_yields(db))
+        else:
+            world = load_world(db)
+            pipeline.run(world)
+            save_world(db, world)
+            deltas = world.deltas
+
+        db.add(tick)
+        db.flush()
+        db.merge(TickHead(tick_id=tick.id, ticked_at=tick.created_at))
+        compact_ticks(db, datetime.now(UTC), tick)
+        db.commit()
+
+        # Only credited and logged once saved, so a crash can't replay the tick's
+        # deltas and let it run again.
+        if state.game:
+            state.game.credit(deltas)
+        leaderboards.credit(deltas)
+
+    next_tick_at = created_at + timedelta(seconds=Tick.LENGTH)
 
-    db.add(tick)
-    db.commit()
     db.refresh(tick)
+    snapshot.publish(db, cast(int, tick.id))
+
     return tick
+
+
+def compact_ticks(db: Session, now: datetime, head: Tick):
+    """
+    Roll ticks past retention into hourly summaries,
+    and hourly summaries past theirs into daily ones.
+    """
+
+    summaries: dict[tuple[str, datetime], TickSummary] = {}
+
+    def summarize(
+        period: str,
+        started_at: datetime,
+        first_tick_id: int,
+        last_tick_id: int,
+        count: int,
+    ):
+        key = (period, started_at.replace(tzinfo=None))
+        if key not in summaries:
+            summary = db.exec(
+                select(TickSummary).where(
+                    TickSummary.period == period,
+                    TickSummary.started_at == started_at,
+                )
+            ).first()
+            if not summary:
+                summary = TickSummary(
+                    period=period,
+                    started_at=started_at,
+                    first_tick_id=first_tick_id,
+                    last_tick_id=last_tick_id,
+                    count=0,
+                )
+                db.add(summary)
+            summaries[key] = summary
+
+        summary = summaries[key]
+        summary.first_tick_id = min(summary.first_tick_id, first_tick_id)
+        summary.last_tick_id = max(summary.last_tick_id, last_tick_id)
+        summary.count += count
+
+    ticks = db.exec(
+        select(Tick).where(
+            col(Tick.created_at) < now - Tick.RETENTION, Tick.id != head.id
+        )
+    ).all()
+    for tick in ticks:
+        started_at = tick.created_at.replace(minute=0, second=0, microsecond=0)
+        tick_id = cast(int, tick.id)
+        summarize("hour", started_at, tick_id, tick_id, 1)
+        db.delete(tick)
+
+    hourly_summaries = db.exec(
+        select(TickSummary).where(
+            TickSummary.period == "hour",
+            col(TickSummary.started_at) < now - TickSummary.RETENTION,
+        )
+    ).all()
+    for summary in hourly_summaries:
+        started_at = summary.started_at.replace(hour=0)
+        summarize(
+            "day",
+            started_at,
+            summary.first_tick_id,
+            summary.last_tick_id,
+            summary.count,
+        )
+        db.delete(summary)
@@ -5,8 +5,9 @@ from fastapi import FastAPI, Request
 from fastapi.responses import Response
 from pydantic import ValidationError
 from sqlalchemy.orm.exc import NoResultFound
+from sqlmodel import Session
 
-from browserstrategygame import config, database
+from browserstrategygame import config, database, snapshot, state
 from browserstrategygame.api import v1
 
 
@@ -19,8 +20,22 @@ async def lifespan(app: FastAPI):
     database.migrate()
     database.seed()
 
+    if config.state_wal:
+        state.game = state.GameState(
+            database.engine, config.state_wal, config.state_checkpoint_interval
+        )
+        state.game.start()
+
+    with Session(database.engine) as db:
+        head = db.get(database.TickHead, 1)
+        snapshot.publish(db, head.tick_id if head else 0)
+
     yield
 
+    if state.game:
+        state.game.stop()
+        state.game = None
+
 
 app = FastAPI(
     title="Browser Strategy Game API",
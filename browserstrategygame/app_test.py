@@ -1,10 +1,15 @@
-from datetime import UTC, datetime
+from collections import Counter
+from datetime import UTC, datetime, timedelta
+from functools import partial
+from random import Random
+from threading import Event
 
 from fastapi.testclient import TestClient
-from pytest import fixture
+from pytest import fixture, raises
 from sqlalchemy import StaticPool
-from sqlmodel import SQLModel, Session, create_engine
+from sqlmodel import SQLModel, Session, create_engine, select
 
+from browserstrategygame import config, snapshot, state
 from browserstrategygame.app import app
 from browserstrategygame.database import (
     yield_session,
@@ -12,9 +17,19 @@ from browserstrategygame.database import (
     Player,
     Realm,
     Storage,
+    Building,
     BuildingTemplate,
     MaterialCost,
+    MaterialYield,
+    Tick,
+    TickSummary,
 )
+from browserstrategygame.api.v1 import ticks
+from browserstrategygame.api.v1.ticks import ticking
+from browserstrategygame.leaderboards import Leaderboard, leaderboards
+from browserstrategygame.ledger import Ledger
+from browserstrategygame.pipeline import World, pipeline, production
+from browserstrategygame.throttle import rate_limit
 
 # I still don't quite understand why StaticPool is needed here.
 # Without it, it seems that each connection instances its own database.
@@ -49,6 +64,9 @@ def db():
         yield session
 
     SQLModel.metadata.drop_all(engine)
+    rate_limit.buckets.clear()
+    leaderboards.clear()
+    ticks.next_tick_at = None
 
 
 def test_search_materials(db):
@@ -121,6 +139,46 @@ def test_create_building(db):
 
     assert response.status_code == 201
 
+    response = client.get(f"/v1/players/{player.id}/storage")
+    assert response.json()[0]["balance"] == 25
+
+    response = client.post(
+        "/v1/buildings",
+        json={
+            "player_id": player.id,
+            "building_template_id": building_template.id,
+        },
+    )
+
+    assert response.status_code == 422
+
+
+def test_create_building_costs_in_same_material(db):
+    wood = Material(name="Wood")
+    db.add(wood)
+    db.commit()
+    db.refresh(wood)
+
+    player = Player(
+        name="Player",
+        realm=Realm(name="Realm"),
+        storage=[Storage(material_id=wood.id, balance=60)],
+    )
+    db.add(player)
+    db.commit()
+    db.refresh(player)
+
+    building_template = BuildingTemplate(
+        name="Quarry",
+        material_costs=[
+            MaterialCost(material_id=wood.id, quantity=50),
+            MaterialCost(material_id=wood.id, quantity=25),
+        ],
+    )
+    db.add(building_template)
+    db.commit()
+    db.refresh(building_template)
+
     response = client.post(
         "/v1/buildings",
         json={
@@ -130,3 +188,456 @@ def test_create_building(db):
     )
 
     assert response.status_code == 422
+
+    response = client.get(f"/v1/players/{player.id}/storage")
+    assert response.json()[0]["balance"] == 60
+
+
+def test_ledger_pay():
+    ledger = Ledger(1)
+    ledger.set(2, 60)
+
+    # Costs in the same material add up.
+    assert not ledger.pay([(2, 50), (2, 25)])
+    assert ledger[2] == 60
+
+    assert ledger.pay([(2, 40), (2, 20)])
+    assert ledger[2] == 0
+
+
+def test_rate_limit(db, monkeypatch):
+    # Slow enough that no token is refilled while the test runs.
+    monkeypatch.setattr(rate_limit, "rate", 0.01)
+
+    for _ in range(rate_limit.burst):
+        response = client.get("/v1/materials")
+        assert response.status_code == 200
+
+    response = client.get("/v1/materials")
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+
+    # Resources don't have buckets of their own, the caller's is already empty.
+    response = client.get("/v1/players/1/storage")
+    assert response.status_code == 429
+
+
+def test_create_tick_in_progress(db):
+    with ticking:
+        response = client.post("/v1/ticks")
+        assert response.status_code == 409
+
+    response = client.post("/v1/ticks")
+    assert response.status_code == 200
+
+
+def test_create_tick_too_soon(db, monkeypatch):
+    response = client.post("/v1/ticks")
+    assert response.status_code == 200
+
+    def refuse_session():
+        raise AssertionError("Opened a database session")
+
+    # Rejected from the cached time of the next tick alone.
+    monkeypatch.setitem(app.dependency_overrides, yield_session, refuse_session)
+    response = client.post("/v1/ticks")
+    assert response.status_code == 409
+
+    # After a restart the first attempt seeds it from the tick head.
+    monkeypatch.setitem(app.dependency_overrides, yield_session, override_yield_session)
+    monkeypatch.setattr(ticks, "next_tick_at", None)
+    response = client.post("/v1/ticks")
+    assert response.status_code == 409
+    assert ticks.next_tick_at
+
+
+def test_create_tick(db):
+    stone = Material(name="Stone")
+    wood = Material(name="Wood")
+    db.add(stone)
+    db.add(wood)
+    db.commit()
+    db.refresh(stone)
+    db.refresh(wood)
+
+    player = Player(
+        name="Player",
+        realm=Realm(name="Realm"),
+        storage=[Storage(material_id=wood.id, balance=10)],
+    )
+    quarry = BuildingTemplate(
+        name="Quarry",
+        material_yields=[MaterialYield(material_id=stone.id, quantity=100)],
+    )
+    lumberyard = BuildingTemplate(
+        name="Lumberyard",
+        material_yields=[MaterialYield(material_id=wood.id, quantity=50)],
+    )
+    db.add(Building(player=player, building_template=quarry))
+    db.add(Building(player=player, building_template=quarry))
+    db.add(Building(player=player, building_template=lumberyard))
+    db.commit()
+    db.refresh(player)
+
+    response = client.post("/v1/ticks")
+    assert response.status_code == 200
+
+    response = client.get(f"/v1/players/{player.id}/storage")
+    balances = {
+        storage["material_id"]: storage["balance"] for storage in response.json()
+    }
+    assert balances == {stone.id: 200, wood.id: 60}
+
+
+def test_game_state(db, tmp_path, monkeypatch):
+    wood = Material(name="Wood")
+    db.add(wood)
+    db.commit()
+    db.refresh(wood)
+
+    player = Player(
+        name="Player",
+        realm=Realm(name="Realm"),
+        storage=[Storage(material_id=wood.id, balance=100)],
+    )
+    lumberyard = BuildingTemplate(
+        name="Lumberyard",
+        material_costs=[MaterialCost(material_id=wood.id, quantity=75)],
+        material_yields=[MaterialYield(material_id=wood.id, quantity=10)],
+    )
+    db.add(player)
+    db.add(lumberyard)
+    db.commit()
+    db.refresh(player)
+    db.refresh(lumberyard)
+
+    wal_path = str(tmp_path / "state.wal")
+    game = state.GameState(engine, wal_path, 60)
+    game.start()
+    monkeypatch.setattr(state, "game", game)
+
+    response = client.post(
+        "/v1/buildings",
+        json={"player_id": player.id, "building_template_id": lumberyard.id},
+    )
+    assert response.status_code == 201
+
+    response = client.post("/v1/ticks")
+    assert response.status_code == 200
+
+    response = client.get(f"/v1/players/{player.id}/storage")
+    assert response.json() == [
+        {"player_id": player.id, "material_id": wood.id, "balance": 35}
+    ]
+
+    # A building the player can't pay for is removed again.
+    response = client.post(
+        "/v1/buildings",
+        json={"player_id": player.id, "building_template_id": lumberyard.id},
+    )
+    assert response.status_code == 422
+    assert len(db.exec(select(Building)).all()) == 1
+
+    # Crash before checkpointing, the database is behind.
+    game.stop(checkpoint=False)
+    assert db.exec(select(Storage.balance)).one() == 100
+
+    # Recovery replays the log.
+    game = state.GameState(engine, wal_path, 60)
+    game.start()
+    assert game.storage(player.id) == [(wood.id, 35)]
+    assert db.exec(select(Storage.balance)).one() == 35
+    game.stop()
+
+
+def test_compact_ticks(db):
+    now = datetime.now(UTC).replace(minute=30)
+    db.add(Tick(created_at=now - timedelta(days=40)))
+    db.add(Tick(created_at=now - timedelta(days=40, minutes=1)))
+    db.add(Tick(created_at=now - timedelta(days=2)))
+    db.add(Tick(created_at=now - timedelta(days=2, minutes=1)))
+    db.add(Tick(created_at=now - timedelta(hours=1)))
+    db.commit()
+
+    response = client.post("/v1/ticks")
+    assert response.status_code == 200
+    tick = response.json()
+
+    response = client.get("/v1/ticks/current")
+    assert response.json() == tick
+
+    response = client.get("/v1/ticks")
+    assert len(response.json()) == 2
+
+    summaries = db.exec(select(TickSummary)).all()
+    assert sorted((summary.period, summary.count) for summary in summaries) == [
+        ("day", 2),
+        ("hour", 2),
+    ]
+
+    response = client.post("/v1/ticks")
+    assert response.status_code == 200
+    assert response.json()["id"] != tick["id"]
+
+
+def test_get_leaderboard(db):
+    wood = Material(name="Wood")
+    db.add(wood)
+    db.commit()
+    db.refresh(wood)
+
+    realm = Realm(name="Realm")
+    alice = Player(
+        name="Alice",
+        realm=realm,
+        storage=[Storage(material_id=wood.id, balance=100)],
+    )
+    bob = Player(name="Bob", realm=realm)
+    lumberyard = BuildingTemplate(
+        name="Lumberyard",
+        material_costs=[MaterialCost(material_id=wood.id, quantity=50)],
+        material_yields=[MaterialYield(material_id=wood.id, quantity=10)],
+    )
+    db.add(Building(player=bob, building_template=lumberyard))
+    db.add(alice)
+    db.commit()
+    db.refresh(realm)
+    db.refresh(alice)
+    db.refresh(bob)
+    db.refresh(lumberyard)
+
+    response = client.get(f"/v1/realms/{realm.id}/leaderboard")
+    assert response.status_code == 200
+    assert response.json()["material_totals"] == {str(wood.id): 100}
+
+    response = client.post(
+        "/v1/buildings",
+        json={"player_id": alice.id, "building_template_id": lumberyard.id},
+    )
+    building = response.json()
+    client.post("/v1/ticks")
+
+    response = client.get(f"/v1/realms/{realm.id}/leaderboard")
+    assert response.json() == {
+        "material_totals": {str(wood.id): 70},
+        "building_counts": {str(lumberyard.id): 2},
+        "top_players_by_material": {
+            str(wood.id): [
+                {"player_id": alice.id, "balance": 60},
+                {"player_id": bob.id, "balance": 10},
+            ]
+        },
+        "top_players_by_buildings": [
+            {"player_id": bob.id, "buildings": 1},
+            {"player_id": alice.id, "buildings": 1},
+        ],
+    }
+
+    client.delete(f"/v1/buildings/{building['id']}")
+
+    response = client.get(f"/v1/realms/{realm.id}/leaderboard")
+    assert response.json()["building_counts"] == {str(lumberyard.id): 1}
+    assert response.json()["top_players_by_buildings"][0]["player_id"] == bob.id
+
+
+def test_leaderboard_rankings():
+    board = Leaderboard()
+    board.rank(1, Counter())
+    random = Random(0)
+
+    # Rankings kept up to date by credits match ranking every player again.
+    for _ in range(1000):
+        board.credit(random.randrange(30), 1, random.randrange(-50, 100))
+        ranking = board.rank(1, board.balances[1])
+        assert all(
+            board.balances[1][player_id] == score for player_id, score in ranking
+        )
+        assert [score for _, score in ranking] == sorted(
+            board.balances[1].values(), reverse=True
+        )[: Leaderboard.SIZE]
+
+
+def test_tick_pipeline(db, monkeypatch):
+    wood = Material(name="Wood")
+    db.add(wood)
+    db.commit()
+    db.refresh(wood)
+
+    player = Player(
+        name="Player",
+        realm=Realm(name="Realm"),
+        storage=[Storage(material_id=wood.id, balance=10)],
+    )
+    db.add(player)
+    db.commit()
+    db.refresh(player)
+
+    def upkeep(world: World, quantity: int):
+        world.credit([(player_id, wood.id, -quantity) for player_id in world.ledgers])
+
+    # Stages may share a name, or have none.
+    monkeypatch.setattr(
+        pipeline,
+        "stages",
+        [*pipeline.stages, partial(upkeep, quantity=1), production, production],
+    )
+
+    response = client.post("/v1/ticks")
+    assert response.status_code == 200
+
+    response = client.get(f"/v1/players/{player.id}/storage")
+    assert response.json()[0]["balance"] == 9
+
+    response = client.get("/v1/ticks/stages")
+    stages = response.json()
+    assert [stage["position"] for stage in stages] == [0, 1, 2, 3]
+    assert [stage["name"] for stage in stages[2:]] == ["production", "production"]
+    assert all(stage["seconds"] >= 0 for stage in stages)
+
+
+def test_snapshot_reads(db, monkeypatch):
+    monkeypatch.setattr(config, "snapshot_reads", True)
+    monkeypatch.setattr(snapshot, "current", None)
+
+    wood = Material(name="Wood")
+    db.add(wood)
+    db.commit()
+    db.refresh(wood)
+
+    player = Player(
+        name="Player",
+        realm=Realm(name="Realm"),
+        storage=[Storage(material_id=wood.id, balance=100)],
+    )
+    lumberyard = BuildingTemplate(name="Lumberyard")
+    db.add(player)
+    db.add(lumberyard)
+    db.commit()
+    db.refresh(player)
+    db.refresh(lumberyard)
+
+    response = client.post("/v1/ticks")
+    tick = response.json()
+
+    response = client.get(f"/v1/players/{player.id}/storage")
+    assert response.headers["X-Tick-Id"] == str(tick["id"])
+    assert response.json() == [
+        {"player_id": player.id, "material_id": wood.id, "balance": 100}
+    ]
+
+    response = client.post(
+        "/v1/buildings",
+        json={"player_id": player.id, "building_template_id": lumberyard.id},
+    )
+    assert response.status_code == 201
+
+    # Writes show up only once the next tick is published.
+    response = client.get("/v1/buildings")
+    assert response.headers["X-Tick-Id"] == str(tick["id"])
+    assert response.json() == []
+
+    response = client.get("/v1/ticks")
+    assert response.json() == [tick]
+
+
+def test_game_state_checkpoint_failure(db, tmp_path, monkeypatch):
+    wood = Material(name="Wood")
+    db.add(wood)
+    db.commit()
+    db.refresh(wood)
+
+    player = Player(
+        name="Player",
+        realm=Realm(name="Realm"),
+        storage=[Storage(material_id=wood.id, balance=100)],
+    )
+    lumberyard = BuildingTemplate(name="Lumberyard")
+    db.add(player)
+    db.add(lumberyard)
+    db.commit()
+    db.refresh(player)
+    db.refresh(lumberyard)
+
+    failed = Event()
+
+    class FailingSession(Session):
+        def commit(self):
+            if not failed.is_set():
+                failed.set()
+                raise RuntimeError("database is locked")
+            super().commit()
+
+    monkeypatch.setattr(state, "Session", FailingSession)
+
+    game = state.GameState(engine, str(tmp_path / "state.wal"), 0.01)
+    game.start()
+    assert game.build(player.id, lumberyard.id, [(wood.id, 75)])
+    assert failed.wait(5)
+
+    # The writer survived the failed checkpoint.
+    assert game.thread and game.thread.is_alive()
+    assert game.storage(123) == []
+    assert 123 not in game.ledgers
+
+    # And the next one still saves what the failed one didn't.
+    game.call(game._checkpoint)
+    assert db.exec(select(Storage.balance)).one() == 25
+
+    game.stop()
+
+    with raises(RuntimeError):
+        game.storage(123)
+
+
+def test_game_state_failed_tick(db, tmp_path, monkeypatch):
+    wood = Material(name="Wood")
+    db.add(wood)
+    db.commit()
+    db.refresh(wood)
+
+    player = Player(
+        name="Player",
+        realm=Realm(name="Realm"),
+        storage=[Storage(material_id=wood.id, balance=100)],
+    )
+    lumberyard = BuildingTemplate(
+        name="Lumberyard",
+        material_yields=[MaterialYield(material_id=wood.id, quantity=10)],
+    )
+    db.add(Building(player=player, building_template=lumberyard))
+    db.commit()
+    db.refresh(player)
+
+    wal_path = tmp_path / "state.wal"
+    game = state.GameState(engine, str(wal_path), 60)
+    game.start()
+    monkeypatch.setattr(state, "game", game)
+
+    def fail(world: World):
+        raise RuntimeError("stage failed")
+
+    monkeypatch.setattr(pipeline, "stages", [*pipeline.stages, fail])
+
+    with raises(RuntimeError):
+        client.post("/v1/ticks")
+
+    # Neither the balances, the log nor the tick history saw a partial tick.
+    assert game.storage(player.id) == [(wood.id, 100)]
+    assert wal_path.read_text() == ""
+    assert db.exec(select(Tick)).all() == []
+
+    def fail_compact(*args):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(pipeline, "stages", pipeline.stages[:-1])
+    monkeypatch.setattr(ticks, "compact_ticks", fail_compact)
+
+    with raises(RuntimeError):
+        client.post("/v1/ticks")
+
+    # Nor a tick that couldn't be saved.
+    assert game.storage(player.id) == [(wood.id, 100)]
+    assert wal_path.read_text() == ""
+    assert db.exec(select(Tick)).all() == []
+
+    game.stop()
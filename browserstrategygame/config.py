@@ -3,3 +3,8 @@ from os import environ
 database_url = environ.get("DATABASE_URL", "sqlite:///development.db")
 port = int(environ.get("PORT", 8000))
 debug = bool(environ.get("DEBUG", True))
+rate_limit = float(environ.get("RATE_LIMIT", 10))
+rate_limit_burst = int(environ.get("RATE_LIMIT_BURST", 20))
+state_wal = environ.get("STATE_WAL")
+state_checkpoint_interval = float(environ.get("STATE_CHECKPOINT_INTERVAL", 5))
+snapshot_reads = environ.get("SNAPSHOT_READS", "").lower() in ("1", "true", "yes")
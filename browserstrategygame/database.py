@@ -1,4 +1,4 @@
-from datetime import datetime, UTC
+from datetime import datetime, timedelta, UTC
 from re import sub
 from typing import Annotated, ClassVar, Optional, TypeVar
 
@@ -56,7 +56,7 @@ class ModelTimestamps(SQLModel):
         Soft-delete the model.
         """
 
-        self.update(deleted_at=datetime.now(UTC))
+        self.deleted_at = datetime.now(UTC)
 
     @hybrid_property
     def not_deleted(self):
@@ -91,15 +91,6 @@ class Player(ModelBase, ModelId, ModelTimestamps, table=True):
     realm_id: int = Field(foreign_key="realm.id")
     realm: "Realm" = Relationship(back_populates="players")
 
-    def pay_stored_material(self, material_id: int, quantity: int):
-        for storage in self.storage:
-            if storage.material_id == material_id:
-                if storage.balance >= quantity:
-                    storage.balance -= quantity
-                    return True
-
-        return False
-
 
 class Material(ModelBase, ModelId, ModelTimestamps, table=True):
     """
@@ -182,6 +173,47 @@ class Tick(ModelBase, ModelId, ModelTimestamps, table=True):
 
     # Seconds between game ticks.
     LENGTH: ClassVar[int] = 60
+    # How long ticks are kept before being rolled into summaries.
+    RETENTION: ClassVar[timedelta] = timedelta(days=1)
+
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(UTC),
+        index=True,
+    )
+
+
+class TickHead(ModelBase, table=True):
+    """
+    Points to the latest tick, so finding it doesn't sort the tick history.
+    """
+
+    id: int = Field(default=1, primary_key=True)
+    tick_id: int = Field(foreign_key="tick.id")
+    ticked_at: datetime
+
+
+class TickSummary(ModelBase, ModelId, table=True):
+    """
+    Ticks past retention, rolled up by the hour, then by the day.
+    """
+
+    # How long hourly summaries are kept before being rolled into daily ones.
+    RETENTION: ClassVar[timedelta] = timedelta(days=30)
+
+    period: str
+    started_at: datetime = Field(index=True)
+    first_tick_id: int
+    last_tick_id: int
+    count: int
+
+
+class Checkpoint(ModelBase, table=True):
+    """
+    How far the write-ahead log of the in-memory game state has been saved.
+    """
+
+    id: int = Field(default=1, primary_key=True)
+    sequence: int = 0
 
 
 # -
@@ -0,0 +1,189 @@
+from collections import Counter
+from collections.abc import Hashable, Iterable
+from heapq import nlargest
+from threading import RLock
+
+from sqlmodel import Session, col, func, select
+
+from browserstrategygame import state
+from browserstrategygame.database import Building, Player, Storage
+from browserstrategygame.pipeline import Delta
+
+
+class Leaderboard:
+    """
+    Aggregates of a realm, kept up to date as balances and buildings change.
+    """
+
+    # How many players are ranked.
+    SIZE = 10
+
+    def __init__(self):
+        # Material id to total balance across the realm.
+        self.material_totals: Counter[int] = Counter()
+        # Building template id to how many of it were built across the realm.
+        self.building_counts: Counter[int] = Counter()
+        # Material id to each player's balance.
+        self.balances: dict[int, Counter[int]] = {}
+        # Player id to how many buildings they own.
+        self.buildings: Counter[int] = Counter()
+        # Material id, or None for buildings, to its top players.
+        self.rankings: dict[Hashable, list[tuple[int, int]]] = {}
+
+    def credit(self, player_id: int, material_id: int, quantity: int):
+        self.material_totals[material_id] += quantity
+        balances = self.balances.setdefault(material_id, Counter())
+        balances[player_id] += quantity
+        self.rerank(material_id, balances, player_id, quantity)
+
+    def build(self, player_id: int, building_template_id: int, count: int):
+        self.building_counts[building_template_id] += count
+        self.buildings[player_id] += count
+        self.rerank(None, self.buildings, player_id, count)
+
+    def rerank(self, key: Hashable, scores: Counter[int], player_id: int, change: int):
+        """
+        Fold a player's new score into the ranking, in O(SIZE), so applying a
+        tick's deltas keeps it ready to read. Only a ranked player losing score
+        could let an unranked one in, that drops it to be ranked again on read.
+        """
+
+        ranking = self.rankings.get(key)
+        if ranking is None:
+            return
+
+        others = [entry for entry in ranking if entry[0] != player_id]
+        ranked = len(others) < len(ranking)
+        if change < 0 and ranked and len(ranking) == self.SIZE:
+            del self.rankings[key]
+            return
+
+        others.append((player_id, scores[player_id]))
+        self.rankings[key] = nlargest(self.SIZE, others, lambda i: i[1])
+
+    def rank(self, key: Hashable, scores: Counter[int]) -> list[tuple[int, int]]:
+        """
+        Top (player_id, score), ranking every player only when there's no ranking
+        to keep up to date yet.
+        """
+
+        if key not in self.rankings:
+            self.rankings[key] = nlargest(self.SIZE, scores.items(), lambda i: i[1])
+        return self.rankings[key]
+
+    def summary(self):
+        return {
+            "material_totals": dict(self.material_totals),
+            "building_counts": dict(self.building_counts),
+            "top_players_by_material": {
+                material_id: [
+                    {"player_id": player_id, "balance": balance}
+                    for player_id, balance in self.rank(material_id, balances)
+                ]
+                for material_id, balances in self.balances.items()
+            },
+            "top_players_by_buildings": [
+                {"player_id": player_id, "buildings": buildings}
+                for player_id, buildings in self.rank(None, self.buildings)
+            ],
+        }
+
+
+class Leaderboards:
+    """
+    Leaderboard of each realm, loaded on first read then updated by every write.
+
+    Writers hold the lock from their commit until their deltas are applied,
+    so a realm is never loaded in between and the deltas counted twice.
+    Readers hold it while serializing, so they never see a write half-applied.
+    """
+
+    def __init__(self):
+        self.boards: dict[int, Leaderboard] = {}
+        # Player id to realm id, for players of loaded realms.
+        self.realms: dict[int, int] = {}
+        self.lock = RLock()
+
+    def get(self, db: Session, realm_id: int) -> Leaderboard:
+        with self.lock:
+            if realm_id not in self.boards:
+                self.boards[realm_id] = self.load(db, realm_id)
+            return self.boards[realm_id]
+
+    def load(self, db: Session, realm_id: int) -> Leaderboard:
+        board = Leaderboard()
+
+        player_ids = [
+            player_id
+            for player_id in db.exec(
+                select(Player.id).where(Player.not_deleted, Player.realm_id == realm_id)
+            )
+            if player_id is not None
+        ]
+        for player_id in player_ids:
+            self.realms[player_id] = realm_id
+
+        if state.game:
+            for player_id, balances in state.game.balances(player_ids).items():
+                for material_id, balance in balances:
+                    board.credit(player_id, material_id, balance)
+        else:
+            for player_id, material_id, balance in db.exec(
+                select(Storage.player_id, Storage.material_id, Storage.balance)
+                .join(Player)
+                .where(Player.not_deleted, Player.realm_id == realm_id)
+            ):
+                board.credit(player_id, material_id, balance)
+
+        for player_id, building_template_id, count in db.exec(
+            select(Building.player_id, Building.building_template_id, func.count())
+            .join(Player)
+            .where(
+                Building.not_deleted,
+                Player.not_deleted,
+                Player.realm_id == realm_id,
+            )
+            .group_by(col(Building.player_id), col(Building.building_template_id))
+        ):
+            board.build(player_id, building_template_id, count)
+
+        return board
+
+    def credit(self, deltas: Iterable[Delta]):
+        with self.lock:
+            for player_id, material_id, quantity in deltas:
+                if player_id in self.realms:
+                    board = self.boards[self.realms[player_id]]
+                    board.credit(player_id, material_id, quantity)
+
+    def build(self, player_id: int, building_template_id: int, count: int = 1):
+        with self.lock:
+            if player_id in self.realms:
+                board = self.boards[self.realms[player_id]]
+                board.build(player_id, building_template_id, count)
+
+    def forget(self, realm_id: int):
+        """
+        Drop the realm's leaderboard to be reloaded, e.g. when its players change.
+        """
+
+        with self.lock:
+            self.boards.pop(realm_id, None)
+            for player_id in [p for p, r in self.realms.items() if r == realm_id]:
+                del self.realms[player_id]
+
+    def summary(self, db: Session, realm_id: int) -> dict:
+        """
+        Serialize the realm's leaderboard without writers changing it meanwhile.
+        """
+
+        with self.lock:
+            return self.get(db, realm_id).summary()
+
+    def clear(self):
+        with self.lock:
+            self.boards.clear()
+            self.realms.clear()
+
+
+leaderboards = Leaderboards()
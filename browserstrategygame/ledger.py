@@ -0,0 +1,135 @@
+from array import array
+from collections import Counter
+from collections.abc import Callable, Iterable, Iterator
+from itertools import repeat
+from typing import Any
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import Session, col, select
+
+from browserstrategygame.database import Storage
+
+# Core SQLAlchemy can't upsert, these dialects' inserts can, the same way.
+inserts: dict[str, Callable[..., Any]] = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+class Ledger:
+    """
+    A player's storage balances, indexed by material id.
+    """
+
+    __slots__ = ("player_id", "balances", "stored", "dirty")
+
+    def __init__(self, player_id: int):
+        self.player_id = player_id
+        self.balances = array("q")
+        # Materials the player has a storage row for.
+        self.stored: set[int] = set()
+        # Materials changed since the ledger was loaded or saved.
+        self.dirty: set[int] = set()
+
+    def __getitem__(self, material_id: int) -> int:
+        if material_id < len(self.balances):
+            return self.balances[material_id]
+        return 0
+
+    def __iter__(self) -> Iterator[tuple[int, int]]:
+        """
+        Iterate (material_id, balance) for every stored material.
+        """
+
+        for material_id in sorted(self.stored):
+            yield material_id, self.balances[material_id]
+
+    def set(self, material_id: int, balance: int):
+        """
+        Set the balance without marking it as changed, e.g. when loading.
+        """
+
+        if material_id >= len(self.balances):
+            self.balances.extend(repeat(0, material_id + 1 - len(self.balances)))
+        self.balances[material_id] = balance
+        self.stored.add(material_id)
+
+    def credit(self, material_id: int, quantity: int):
+        self.set(material_id, self[material_id] + quantity)
+        self.dirty.add(material_id)
+
+    def pay(self, costs: Iterable[tuple[int, int]]) -> bool:
+        """
+        Debit every (material_id, quantity) cost, or none of them if any can't be paid.
+        """
+
+        # Several costs may be in the same material, check against their sum.
+        totals: Counter[int] = Counter()
+        for material_id, quantity in costs:
+            totals[material_id] += quantity
+
+        for material_id, quantity in totals.items():
+            if material_id not in self.stored or self[material_id] < quantity:
+                return False
+
+        for material_id, quantity in totals.items():
+            self.credit(material_id, -quantity)
+
+        return True
+
+    def copy(self) -> "Ledger":
+        ledger = Ledger(self.player_id)
+        ledger.balances = array("q", self.balances)
+        ledger.stored = set(self.stored)
+        return ledger
+
+    @classmethod
+    def load(cls, db: Session, player_id: int) -> "Ledger":
+        return load_ledgers(db, [player_id])[player_id]
+
+
+def load_ledgers(db: Session, player_ids: Iterable[int]) -> dict[int, Ledger]:
+    """
+    Load the ledgers of the given players in a single query.
+    """
+
+    ledgers = {player_id: Ledger(player_id) for player_id in player_ids}
+
+    query = select(Storage.player_id, Storage.material_id, Storage.balance).where(
+        col(Storage.player_id).in_(list(ledgers))
+    )
+    for player_id, material_id, balance in db.exec(query):
+        ledgers[player_id].set(material_id, balance)
+
+    return ledgers
+
+
+def save_ledgers(db: Session, ledgers: Iterable[Ledger]):
+    """
+    Write changed balances back in a single upsert statement.
+    Balances stay marked as changed, callers clear them once they commit.
+    """
+
+    rows = [
+        {
+            "player_id": ledger.player_id,
+            "material_id": material_id,
+            "balance": ledger[material_id],
+        }
+        for ledger in ledgers
+        for material_id in ledger.dirty
+    ]
+
+    if not rows:
+        return
+
+    dialect = db.get_bind().dialect.name
+    if dialect not in inserts:
+        raise NotImplementedError(f"Saving ledgers isn't supported on {dialect}")
+
+    statement = inserts[dialect](Storage)
+    statement = statement.on_conflict_do_update(
+        index_elements=["player_id", "material_id"],
+        set_={"balance": statement.excluded.balance},
+    )
+    db.execute(statement, rows)
@@ -0,0 +1,143 @@
+from collections import Counter
+from collections.abc import Callable
+from time import perf_counter
+
+from sqlmodel import Session, col, func, select
+
+from browserstrategygame.database import Building, MaterialYield, Storage
+from browserstrategygame.ledger import Ledger, save_ledgers
+
+# A change to a player's balance, i.e. (player_id, material_id, quantity).
+Delta = tuple[int, int, int]
+
+
+class World:
+    """
+    Everything a tick works on, loaded in one batch and written back once.
+    """
+
+    def __init__(
+        self,
+        ledgers: dict[int, Ledger],
+        building_counts: Counter[tuple[int, int]],
+        material_yields: dict[int, list[tuple[int, int]]],
+    ):
+        # Player id to their balances.
+        self.ledgers = ledgers
+        # (player_id, building_template_id) to how many the player owns.
+        self.building_counts = building_counts
+        # Building template id to (material_id, quantity) it yields.
+        self.material_yields = material_yields
+        # Every balance change made during the tick.
+        self.deltas: list[Delta] = []
+
+    def ledger(self, player_id: int) -> Ledger:
+        if player_id not in self.ledgers:
+            self.ledgers[player_id] = Ledger(player_id)
+        return self.ledgers[player_id]
+
+    def credit(self, deltas: list[Delta]):
+        for player_id, material_id, quantity in deltas:
+            self.ledger(player_id).credit(material_id, quantity)
+        self.deltas.extend(deltas)
+
+
+# A step of the tick, e.g. production, upkeep, decay.
+Stage = Callable[[World], None]
+
+
+class Pipeline:
+    """
+    Stages applied to the world, in order, every tick.
+    """
+
+    def __init__(self):
+        self.stages: list[Stage] = []
+        # How many seconds each stage, by position, took on the last tick.
+        # Names aren't unique, nor always there, e.g. on a partial.
+        self.timings: list[float] = []
+
+    def stage(self, stage: Stage) -> Stage:
+        """
+        Register a stage. Can be used as a decorator.
+        """
+
+        self.stages.append(stage)
+        return stage
+
+    def run(self, world: World):
+        timings = []
+        for stage in self.stages:
+            started_at = perf_counter()
+            stage(world)
+            timings.append(perf_counter() - started_at)
+        self.timings = timings
+
+
+pipeline = Pipeline()
+
+
+@pipeline.stage
+def production(world: World):
+    """
+    Buildings produce materials.
+    """
+
+    deltas = []
+    for (player_id, building_template_id), count in world.building_counts.items():
+        for material_id, quantity in world.material_yields.get(
+            building_template_id, []
+        ):
+            deltas.append((player_id, material_id, quantity * count))
+    world.credit(deltas)
+
+
+def load_material_yields(db: Session) -> dict[int, list[tuple[int, int]]]:
+    material_yields: dict[int, list[tuple[int, int]]] = {}
+    for building_template_id, material_id, quantity in db.exec(
+        select(
+            MaterialYield.building_template_id,
+            MaterialYield.material_id,
+            MaterialYield.quantity,
+        )
+    ):
+        material_yields.setdefault(building_template_id, []).append(
+            (material_id, quantity)
+        )
+    return material_yields
+
+
+def load_building_counts(db: Session) -> Counter[tuple[int, int]]:
+    return Counter(
+        {
+            (player_id, building_template_id): count
+            for player_id, building_template_id, count in db.exec(
+                select(Building.player_id, Building.building_template_id, func.count())
+                .where(Building.not_deleted)
+                .group_by(col(Building.player_id), col(Building.building_template_id))
+            )
+        }
+    )
+
+
+def load_world(db: Session) -> World:
+    """
+    Load balances, building counts and yields in three queries.
+    """
+
+    world = World({}, load_building_counts(db), load_material_yields(db))
+
+    for player_id, material_id, balance in db.exec(
+        select(Storage.player_id, Storage.material_id, Storage.balance)
+    ):
+        world.ledger(player_id).set(material_id, balance)
+
+    return world
+
+
+def save_world(db: Session, world: World):
+    """
+    Write back every balance changed by the tick in one statement.
+    """
+
+    save_ledgers(db, world.ledgers.values())
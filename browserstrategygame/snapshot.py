@@ -0,0 +1,89 @@
+from http import HTTPStatus
+from types import MappingProxyType
+from typing import Any, Mapping, Optional
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlmodel import Session, col, select
+
+from browserstrategygame import config, state
+from browserstrategygame.database import Building, Storage, Tick
+
+
+def render(content: Any) -> bytes:
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+class Snapshot:
+    """
+    Immutable view of the world as of a tick, already serialized.
+    """
+
+    __slots__ = ("tick_id", "storage", "buildings", "ticks")
+
+    def __init__(
+        self,
+        tick_id: int,
+        storage: Mapping[int, bytes],
+        buildings: bytes,
+        ticks: bytes,
+    ):
+        self.tick_id = tick_id
+        # Player id to their storage.
+        self.storage = storage
+        self.buildings = buildings
+        self.ticks = ticks
+
+    def respond(self, body: bytes) -> Response:
+        return Response(
+            body,
+            status_code=HTTPStatus.OK,
+            media_type="application/json",
+            headers={"X-Tick-Id": str(self.tick_id)},
+        )
+
+
+def publish(db: Session, tick_id: int):
+    """
+    Take a snapshot after a tick commits and swap it in for readers.
+    """
+
+    global current
+
+    if not config.snapshot_reads:
+        return
+
+    storage: dict[int, list[dict[str, int]]] = {}
+
+    if state.game:
+        for player_id, balances in state.game.balances().items():
+            storage[player_id] = [
+                {"player_id": player_id, "material_id": material_id, "balance": balance}
+                for material_id, balance in balances
+            ]
+    else:
+        for player_id, material_id, balance in db.exec(
+            select(Storage.player_id, Storage.material_id, Storage.balance).order_by(
+                col(Storage.player_id), col(Storage.material_id)
+            )
+        ):
+            storage.setdefault(player_id, []).append(
+                {"player_id": player_id, "material_id": material_id, "balance": balance}
+            )
+
+    buildings = db.exec(select(Building).where(Building.not_deleted)).all()
+    ticks = db.exec(select(Tick).order_by(col(Tick.created_at).desc())).all()
+
+    current = Snapshot(
+        tick_id,
+        MappingProxyType(
+            {player_id: render(rows) for player_id, rows in storage.items()}
+        ),
+        render(buildings),
+        render(ticks),
+    )
+
+
+# Latest snapshot, swapped in whole so readers never see a partial one.
+current: Optional[Snapshot] = None
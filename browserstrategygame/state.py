@@ -0,0 +1,315 @@
+import json
+import logging
+from collections import Counter
+from collections.abc import Callable
+from concurrent.futures import Future
+from os import path
+from queue import Empty, SimpleQueue
+from threading import Thread
+from time import monotonic
+from typing import Any, Optional, TextIO
+
+from sqlalchemy import Engine
+from sqlmodel import Session, select
+
+from browserstrategygame.database import Checkpoint, Storage
+from browserstrategygame.ledger import Ledger, save_ledgers
+from browserstrategygame.pipeline import Delta, World, load_building_counts, pipeline
+
+logger = logging.getLogger(__name__)
+
+
+class GameState:
+    """
+    Authoritative in-memory balances and building counts.
+
+    A single writer thread applies every mutation and appends the resulting
+    balance changes to a write-ahead log before acknowledging it.
+    Changed balances are checkpointed to the database periodically, along with
+    the sequence of the last logged change, after which the log is truncated.
+    Building rows are still written by the routers, so building counts are
+    rebuilt from the database on recovery.
+
+    Routers commit a tick or building before applying its balance changes here,
+    so a crash in between loses those changes instead of applying them twice.
+    """
+
+    # Most mutations applied, and logged, per write to the log.
+    BATCH_SIZE = 1024
+
+    def __init__(self, engine: Engine, wal_path: str, checkpoint_interval: float):
+        self.engine = engine
+        self.wal_path = wal_path
+        self.checkpoint_interval = checkpoint_interval
+        self.ledgers: dict[int, Ledger] = {}
+        self.building_counts: Counter[tuple[int, int]] = Counter()
+        self.dirty: set[int] = set()
+        self.sequence = 0
+        self.mailbox: SimpleQueue[
+            Optional[tuple[Callable, tuple, Future]]
+        ] = SimpleQueue()
+        self.thread: Optional[Thread] = None
+        self.wal: Optional[TextIO] = None
+
+    def start(self):
+        """
+        Load state from the database, replay the log and start the writer.
+        """
+
+        self.recover()
+        self.wal = open(self.wal_path, "a")
+        self.thread = Thread(target=self.run, name="game-state", daemon=True)
+        self.thread.start()
+
+    def stop(self, checkpoint: bool = True):
+        """
+        Stop the writer, checkpointing pending changes unless told otherwise.
+        """
+
+        try:
+            if checkpoint:
+                self.call(self._checkpoint)
+        finally:
+            self.mailbox.put(None)
+            if self.thread:
+                self.thread.join()
+            if self.wal:
+                self.wal.close()
+
+    def recover(self):
+        """
+        Load balances and building counts, then replay the log on top.
+        """
+
+        self.ledgers = {}
+
+        with Session(self.engine) as db:
+            checkpoint = db.get(Checkpoint, 1)
+            self.sequence = checkpoint.sequence if checkpoint else 0
+
+            for player_id, material_id, balance in db.exec(
+                select(Storage.player_id, Storage.material_id, Storage.balance)
+            ):
+                self.ledger(player_id).set(material_id, balance)
+
+            self.building_counts = load_building_counts(db)
+
+        if path.exists(self.wal_path):
+            with open(self.wal_path) as wal:
+                for line in wal:
+                    try:
+                        sequence, deltas = json.loads(line)
+                    except ValueError:
+                        # A torn write at the end of the log was never acknowledged.
+                        break
+                    # Skip changes that made it to the database before a crash.
+                    if sequence > self.sequence:
+                        self.apply(deltas)
+                        self.sequence = sequence
+
+        self.checkpoint()
+        open(self.wal_path, "w").close()
+
+    def run(self):
+        deadline = monotonic() + self.checkpoint_interval
+
+        while True:
+            try:
+                message = self.mailbox.get(timeout=max(0, deadline - monotonic()))
+            except Empty:
+                message = (self._checkpoint, (), Future())
+
+            batch = [message]
+            while message and len(batch) < self.BATCH_SIZE:
+                try:
+                    message = self.mailbox.get_nowait()
+                except Empty:
+                    break
+                batch.append(message)
+
+            results: list[tuple[Future, Any, Optional[Exception]]] = []
+            lines = []
+            for message in batch:
+                if message is None:
+                    break
+                fn, args, future = message
+                try:
+                    result, deltas = fn(*args)
+                except Exception as error:
+                    results.append((future, None, error))
+                    continue
+                if deltas:
+                    self.sequence += 1
+                    lines.append(json.dumps([self.sequence, deltas]) + "\n")
+                results.append((future, result, None))
+
+            if lines and self.wal:
+                self.wal.writelines(lines)
+                self.wal.flush()
+
+            for future, result, failure in results:
+                if failure:
+                    future.set_exception(failure)
+                else:
+                    future.set_result(result)
+
+            if None in batch:
+                return
+
+            if monotonic() >= deadline:
+                try:
+                    self.checkpoint()
+                except Exception:
+                    # Changes stay dirty and logged, try again next interval.
+                    logger.exception("Game state checkpoint failed")
+                deadline = monotonic() + self.checkpoint_interval
+
+    def call(self, fn: Callable, *args) -> Any:
+        """
+        Run fn on the writer thread and wait for its result.
+        Fails instead of waiting forever if the writer isn't running.
+        """
+
+        future: Future = Future()
+        self.mailbox.put((fn, args, future))
+
+        while True:
+            if not (self.thread and self.thread.is_alive()) and not future.done():
+                raise RuntimeError("Game state writer is not running")
+            try:
+                return future.result(timeout=1)
+            except TimeoutError:
+                continue
+
+    def ledger(self, player_id: int) -> Ledger:
+        if player_id not in self.ledgers:
+            self.ledgers[player_id] = Ledger(player_id)
+        return self.ledgers[player_id]
+
+    def apply(self, deltas: list[Delta]):
+        for player_id, material_id, quantity in deltas:
+            self.ledger(player_id).credit(material_id, quantity)
+            self.dirty.add(player_id)
+
+    def checkpoint(self):
+        """
+        Write changed balances to the database and truncate the log.
+        """
+
+        if self.dirty:
+            ledgers = [self.ledgers[player_id] for player_id in self.dirty]
+            with Session(self.engine) as db:
+                save_ledgers(db, ledgers)
+                db.merge(Checkpoint(id=1, sequence=self.sequence))
+                db.commit()
+            # Only now, so a failed checkpoint leaves it all for the next one.
+            for ledger in ledgers:
+                ledger.dirty.clear()
+            self.dirty.clear()
+
+        if self.wal:
+            self.wal.seek(0)
+            self.wal.truncate()
+
+    # -
+    # Mutations run on the writer thread and return (result, deltas).
+    # -
+
+    def _checkpoint(self):
+        self.checkpoint()
+        return None, None
+
+    def _tick(self, material_yields: dict[int, list[tuple[int, int]]]):
+        # Stages work on copies, the deltas are only applied once the tick is saved.
+        world = World(
+            {player_id: ledger.copy() for player_id, ledger in self.ledgers.items()},
+            Counter(self.building_counts),
+            material_yields,
+        )
+        pipeline.run(world)
+        return world.deltas, None
+
+    def _credit(self, deltas: list[Delta]):
+        self.apply(deltas)
+        return None, deltas
+
+    def _build(
+        self, player_id: int, building_template_id: int, costs: list[tuple[int, int]]
+    ):
+        if not self.ledger(player_id).pay(costs):
+            return False, None
+
+        self.dirty.add(player_id)
+        self.building_counts[player_id, building_template_id] += 1
+        return True, [
+            (player_id, material_id, -quantity) for material_id, quantity in costs
+        ]
+
+    def _demolish(self, player_id: int, building_template_id: int):
+        self.building_counts[player_id, building_template_id] -= 1
+        return None, None
+
+    def _storage(self, player_id: int):
+        ledger = self.ledgers.get(player_id)
+        return list(ledger) if ledger else [], None
+
+    def _balances(self, player_ids: Optional[list[int]]):
+        if player_ids is None:
+            player_ids = list(self.ledgers)
+
+        return {
+            player_id: list(self.ledgers[player_id])
+            for player_id in player_ids
+            if player_id in self.ledgers
+        }, None
+
+    # -
+    # Thread-safe interface for the routers.
+    # -
+
+    def tick(self, material_yields: dict[int, list[tuple[int, int]]]) -> list[Delta]:
+        """
+        Run the tick pipeline over the in-memory world and return its deltas,
+        to credit once the Tick is saved.
+        """
+
+        return self.call(self._tick, material_yields)
+
+    def credit(self, deltas: list[Delta]):
+        """
+        Apply and log balance changes, e.g. a saved tick's.
+        """
+
+        self.call(self._credit, deltas)
+
+    def build(
+        self, player_id: int, building_template_id: int, costs: list[tuple[int, int]]
+    ) -> bool:
+        """
+        Pay for and count a saved building, unless the player can't afford it.
+        """
+
+        return self.call(self._build, player_id, building_template_id, costs)
+
+    def demolish(self, player_id: int, building_template_id: int):
+        self.call(self._demolish, player_id, building_template_id)
+
+    def storage(self, player_id: int) -> list[tuple[int, int]]:
+        """
+        List (material_id, balance) the player has stored.
+        """
+
+        return self.call(self._storage, player_id)
+
+    def balances(
+        self, player_ids: Optional[list[int]] = None
+    ) -> dict[int, list[tuple[int, int]]]:
+        """
+        Same as storage, for several players at once, or everyone.
+        """
+
+        return self.call(self._balances, player_ids)
+
+
+# Set on startup when the state engine is enabled.
+game: Optional[GameState] = None
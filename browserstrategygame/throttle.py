@@ -0,0 +1,153 @@
+from collections.abc import Callable, Hashable
+from http import HTTPStatus
+from math import ceil
+from threading import Event, Lock
+from time import monotonic
+from typing import Any, Optional
+
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from browserstrategygame import config
+
+
+class TokenBucket:
+    """
+    Tokens left for a single client and when they were last counted.
+    """
+
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, tokens: float, updated_at: float):
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+
+class RateLimiter:
+    """
+    FastAPI dependency that throttles requests with a token bucket per client
+    address. Keyed on the caller, not the resource being requested, so clients
+    can't drain each other's buckets.
+    """
+
+    # Prune idle buckets once we're tracking this many clients.
+    MAX_BUCKETS = 10_000
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.buckets: dict[str, TokenBucket] = {}
+        self.lock = Lock()
+
+    def take(self, key: str) -> float:
+        """
+        Take a token from the bucket. Returns 0 if granted,
+        otherwise how many seconds until a token is available.
+        """
+
+        now = monotonic()
+
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.MAX_BUCKETS:
+                    self.prune(now)
+                bucket = self.buckets[key] = TokenBucket(self.burst, now)
+
+            bucket.tokens = min(
+                self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate
+            )
+            bucket.updated_at = now
+
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0
+
+            return (1 - bucket.tokens) / self.rate
+
+    def prune(self, now: float):
+        """
+        Forget buckets that would have refilled by now anyway.
+        """
+
+        idle = self.burst / self.rate
+        for key, bucket in list(self.buckets.items()):
+            if now - bucket.updated_at > idle:
+                del self.buckets[key]
+
+    def __call__(self, req: Request):
+        if self.rate <= 0:
+            return
+
+        key = f"ip:{req.client.host if req.client else None}"
+
+        if wait := self.take(key):
+            raise HTTPException(
+                HTTPStatus.TOO_MANY_REQUESTS,
+                headers={"Retry-After": str(ceil(wait))},
+            )
+
+
+rate_limit = RateLimiter(config.rate_limit, config.rate_limit_burst)
+
+
+class Flight:
+    """
+    A call in progress and, once done, its outcome.
+    """
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key, so only the first one runs
+    and the others wait for and share its result.
+    """
+
+    def __init__(self):
+        self.flights: dict[Hashable, Flight] = {}
+        self.lock = Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if flight is None:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+        return flight.result
+
+
+single_flight = SingleFlight()
+
+
+def coalesce(key: Hashable, fn: Callable[[], Any]) -> Response:
+    """
+    Run a read once for all concurrent identical requests and share the serialized response.
+    """
+
+    body = single_flight.do(key, lambda: JSONResponse(jsonable_encoder(fn())).body)
+    return Response(body, media_type="application/json")